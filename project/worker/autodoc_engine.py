@@ -10,19 +10,16 @@ import re
 import traceback
 import sys
 from pathlib import Path
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Optional, Tuple
 import logging
-import cv2
 import numpy as np
-from PIL import Image
-import pyautogui
+import urllib3
 
-# Desktop Window Management
-try:
-    import pygetwindow as gw
-except ImportError:
-    gw = None
+# Heavy optional modules (OpenCV, Gemini, webdriver-manager) are imported in the
+# functions that use them, so importing this module stays cheap
 
 # Selenium
 from selenium import webdriver
@@ -40,22 +37,9 @@ from selenium.common.exceptions import (
     NoSuchElementException
 )
 
-# ReportLab (PDF Generation)
-from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Image as RLImage,
-    Spacer, PageBreak, Table, TableStyle
-)
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.units import inch
-from reportlab.lib import colors
-
-# Word Document (Alternative to PDF)
-from docx import Document as DocxDocument
-from docx.shared import Inches, Pt, RGBColor
-
-# Gemini
-import google.generativeai as genai
+# What a dead browser or driver process raises: WebDriver errors, or the HTTP
+# client failing to reach the driver (urllib3 errors, ConnectionRefusedError)
+DRIVER_ERRORS = (WebDriverException, urllib3.exceptions.HTTPError, OSError)
 
 # Logging Setup
 logger = logging.getLogger(__name__)
@@ -81,13 +65,24 @@ class Config:
    
     # Feature flags
     USE_FEATURE_MATCHING = True # Use ORB/SIFT for better matching
+    # pHash Hamming distance (out of 64 bits) below which shots are duplicates;
+    # up to PHASH_AMBIGUOUS_DISTANCE, ORB decides if USE_FEATURE_MATCHING is on
+    PHASH_DUPLICATE_DISTANCE = 8
+    PHASH_AMBIGUOUS_DISTANCE = 16
     GENERATE_HEATMAPS = False # Visual diff heatmaps
     ENABLE_RESUME = True # Resume from last checkpoint
     # NEW: Prefer full page captures
     PREFER_FULL_PAGE = True
+    # Full-page capture encoding; "png" for lossless output
+    SCREENSHOT_FORMAT = "jpeg"
+    SCREENSHOT_QUALITY = 85
+    # Write screenshots to output_dir; disable to discard captures (e.g. passing runs)
+    SAVE_TO_DISK = True
 
 class BrowserManager:
     """Manages browser selection and initialization"""
+    # ChromeDriverManager().install() probes the network; resolve it once per process
+    _chromedriver_path = None
    
     @staticmethod
     def get_available_browsers():
@@ -136,8 +131,10 @@ class BrowserManager:
             if browser == "edge":
                 driver = webdriver.Edge(options=options)
             else:
-                from webdriver_manager.chrome import ChromeDriverManager
-                service = ChromeService(ChromeDriverManager().install())
+                if BrowserManager._chromedriver_path is None:
+                    from webdriver_manager.chrome import ChromeDriverManager
+                    BrowserManager._chromedriver_path = ChromeDriverManager().install()
+                service = ChromeService(BrowserManager._chromedriver_path)
                 driver = webdriver.Chrome(service=service, options=options)
            
             driver.set_page_load_timeout(Config.PAGE_LOAD_TIMEOUT)
@@ -160,205 +157,293 @@ class DeterministicExplorer:
             "logout", "sign out", "delete", "remove",
             "exit", "cancel", "close", "back"
         ]
+        self._avoid_re = re.compile(
+            "|".join(map(re.escape, self.avoid_keywords)), re.IGNORECASE
+        )
         self.interaction_log = []
 
-    def get_element_signature(self, element):
-        """IMPROVED: More robust signature generation"""
-        try:
-            text = (element.text.strip() or
-                   element.get_attribute("aria-label") or
-                   element.get_attribute("name") or
-                   element.get_attribute("id") or
-                   "element")
-           
-            loc = element.location
-            tag = element.tag_name
-           
-            # Create a more unique signature
-            return f"{tag}_{text[:30]}_{loc['x']}_{loc['y']}"
-        except:
+    def get_element_signature(self, meta):
+        """IMPROVED: Signature from one CANDIDATES_JS element meta dict"""
+        if not meta:
             return None
+        text = (meta["text"] or meta["aria"] or meta["name"] or
+                meta["id"] or "element")
+        # Create a more unique signature
+        return f"{meta['tag']}_{text[:30]}_{meta['x']}_{meta['y']}"
 
-    def is_safe_element(self, element):
-        """IMPROVED: Better safety checks"""
-        try:
-            text = (element.text.strip() or
-                   element.get_attribute("aria-label") or
-                   element.get_attribute("name") or "").lower()
-           
-            # Check for dangerous keywords
-            if any(bad in text for bad in self.avoid_keywords):
-                return False
-           
-            # Check if element is in a modal/dialog that might be destructive
-            if element.get_attribute("role") in ["alertdialog", "dialog"]:
-                return False
-           
-            return True
-        except:
+    def is_safe_element(self, meta):
+        """IMPROVED: Safety checks on one CANDIDATES_JS element meta dict"""
+        if not meta:
+            return False
+        text = meta["text"] or meta["aria"] or meta["name"] or ""
+       
+        # Check for dangerous keywords
+        if self._avoid_re.search(text):
             return False
+       
+        # Check if element is in a modal/dialog that might be destructive
+        if meta["role"] in ["alertdialog", "dialog"]:
+            return False
+       
+        return True
+
+    # Collects every visible, enabled interactive element in a single round-trip.
+    # Each match is tagged with data-autodoc-id so the chosen one can be resolved
+    # back to a WebElement without re-reading the others.
+    # All layout reads happen before any attribute is written, so the page is laid
+    # out once instead of being invalidated and re-flushed for every candidate.
+    CANDIDATES_JS = """
+        const els = document.querySelectorAll(
+            "a[href],button:not([disabled]),input[type=submit],input[type=button],[role=button],[onclick]"
+        );
+        const out = [];
+        els.forEach((el, i) => {
+            if (el.disabled) return;
+            // offsetParent is null for position:fixed elements too (sticky headers,
+            // floating buttons), so visibility is checked directly instead
+            const r = el.getBoundingClientRect();
+            const visible = r.width > 0 && r.height > 0 && (el.checkVisibility
+                ? el.checkVisibility({checkOpacity: true, checkVisibilityCSS: true})
+                : getComputedStyle(el).visibility === 'visible');
+            if (!visible) return;
+            out.push({
+                autodoc_id: i,
+                tag: el.tagName.toLowerCase(),
+                text: (el.innerText || '').trim(),
+                aria: el.getAttribute('aria-label'),
+                name: el.getAttribute('name'),
+                id: el.getAttribute('id'),
+                role: el.getAttribute('role'),
+                x: Math.round(r.left + window.scrollX),
+                y: Math.round(r.top + window.scrollY),
+                w: Math.round(r.width),
+                h: Math.round(r.height)
+            });
+        });
+        document.querySelectorAll('[data-autodoc-id]').forEach(el => el.removeAttribute('data-autodoc-id'));
+        out.forEach(c => els[c.autodoc_id].setAttribute('data-autodoc-id', c.autodoc_id));
+        return JSON.stringify(out);
+    """
 
     def get_next_interactive_element(self, driver):
         """
-        IMPROVED: Better element selection with multiple strategies
+        IMPROVED: Collect all candidates with one execute_script call instead of
+        several WebDriver round-trips per element
         """
-        # Strategy 1: Find all interactive elements
-        selectors = [
-            "//a[@href]",
-            "//button[not(@disabled)]",
-            "//input[@type='submit']",
-            "//input[@type='button']",
-            "//*[@role='button']",
-            "//*[@onclick]"
-        ]
+        try:
+            candidates = json.loads(driver.execute_script(self.CANDIDATES_JS))
+        except WebDriverException as e:
+            logger.warning(f"Could not collect interactive elements: {e}")
+            return None, None
        
-        candidates = []
-        for selector in selectors:
-            try:
-                elements = driver.find_elements(By.XPATH, selector)
-                candidates.extend(elements)
-            except:
+        # Structure-of-arrays over the safe, unvisited candidates so the sort
+        # key is vectorised
+        metas, sigs, ys, xs, areas = [], [], [], [], []
+        for meta in candidates:
+            if not self.is_safe_element(meta):
                 continue
-       
-        valid_elements = []
-        for el in candidates:
-            try:
-                if not el.is_displayed() or not el.is_enabled():
-                    continue
-               
-                if not self.is_safe_element(el):
-                    continue
-               
-                sig = self.get_element_signature(el)
-                if not sig or sig in self.visited_signatures:
-                    continue
-               
-                loc = el.location
-                size = el.size
-                text = el.text.strip()[:50] or el.get_attribute("aria-label") or "unlabeled"
-               
-                valid_elements.append({
-                    "element": el,
-                    "signature": sig,
-                    "text": text,
-                    "y": loc['y'],
-                    "x": loc['x'],
-                    "area": size['width'] * size['height']
-                })
-            except:
+            sig = self.get_element_signature(meta)
+            if sig in self.visited_signatures:
                 continue
-        if not valid_elements:
+            metas.append(meta)
+            sigs.append(sig)
+            ys.append(meta["y"])
+            xs.append(meta["x"])
+            areas.append(meta["w"] * meta["h"])
+        if not metas:
             return None, None
        
-        # SORT: Top -> Bottom, Left -> Right (Symmetric Exploration)
-        # Prioritize larger elements (likely more important)
-        valid_elements.sort(key=lambda k: (k['y'] // 100, k['x'] // 100, -k['area']))
-        # Get first unvisited element
-        for item in valid_elements:
-            sig = item['signature']
-            if sig not in self.visited_signatures:
-                self.visited_signatures.add(sig)
-                self.interaction_log.append({
-                    "timestamp": time.time(),
-                    "signature": sig,
-                    "text": item['text']
-                })
-                return item['element'], item['text']
+        ys = np.asarray(ys, dtype=np.int64)
+        xs = np.asarray(xs, dtype=np.int64)
+        areas = np.asarray(areas, dtype=np.int64)
+        # Top -> Bottom, Left -> Right (Symmetric Exploration), larger elements
+        # first within a cell (likely more important). lexsort is stable, so ties
+        # keep document order. Last key is the primary one
+        best_i = np.lexsort((-areas, xs // 100, ys // 100))[0]
+        best, best_sig = metas[best_i], sigs[best_i]
        
-        return None, None
+        text = best["text"][:50] or best["aria"] or "unlabeled"
+        # Signatures are only marked visited once an element is actually selected
+        self.visited_signatures.add(best_sig)
+        try:
+            element = driver.find_element(
+                By.CSS_SELECTOR, f"[data-autodoc-id='{best['autodoc_id']}']"
+            )
+        except WebDriverException:
+            # Page changed under us; skip this one and pick again
+            return self.get_next_interactive_element(driver)
+        self.interaction_log.append({
+            "timestamp": time.time(),
+            "signature": best_sig,
+            "text": text
+        })
+        return element, text
+
+def _decode_and_write(data, path):
+    """
+    Decode a base64 screenshot payload, write it to disk and return a grayscale
+    thumbnail for dedup (runs on the IO pool)
+    """
+    import cv2
+    raw = base64.b64decode(data)
+    with open(path, "wb") as f:
+        f.write(raw)
+    gray = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError("Could not decode screenshot bytes")
+    return path, _thumb(gray)
+
+# Set-bit count for every byte value, used to popcount XORed hashes in bulk
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def _hamming_matrix(hashes):
+    """N x N Hamming distances between 64-bit hashes, computed in one vectorised pass"""
+    h = np.asarray(hashes, dtype=np.uint64)
+    xor = h[:, None] ^ h[None, :]
+    return _POPCOUNT8[xor.view(np.uint8)].reshape(len(h), len(h), 8).sum(axis=-1)
+
+def _thumb(gray, width=512):
+    """
+    Downscale to a fixed width before any signature work; pHash and ORB only
+    need a fraction of a full-page screenshot's pixels
+    """
+    import cv2
+    h, w = gray.shape[:2]
+    if w <= width:
+        return gray
+    return cv2.resize(gray, (width, max(1, width * h // w)), interpolation=cv2.INTER_AREA)
+
+def _tiled_diff(a, b, tile=256):
+    """
+    Absolute difference of two equally sized grayscale images, computed tile by
+    tile so each step stays cache-resident. Identical tiles are skipped, which on
+    UI screenshots is most of the page
+    """
+    import cv2
+    h, w = a.shape[:2]
+    heat = np.zeros((h, w), dtype=np.uint8)
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            ta = a[y:y + tile, x:x + tile]
+            tb = b[y:y + tile, x:x + tile]
+            if np.array_equal(ta, tb):
+                continue
+            heat[y:y + tile, x:x + tile] = cv2.absdiff(ta, tb)
+    return heat
+
+def _phash(gray):
+    """64-bit perceptual hash: low-frequency DCT coefficients against their median"""
+    import cv2
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    bits = (low > np.median(low)).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
 
 class ScreenshotCapture:
     """
     IMPROVED: Multiple capture strategies with fallbacks
     - FIXED: Prefer full page captures for scrollable content
+    - Returns the raw base64 payload; decoding and writing is left to the caller
+      so it can happen off the exploration thread
     """
    
     @staticmethod
-    def capture_web_screenshot(driver, path, method="full"):
+    def capture_web_screenshot(driver, method="full"):
         """
         IMPROVED: Default to full page capture
+        Returns (base64 data, format). Full-page CDP captures use
+        Config.SCREENSHOT_FORMAT; viewport fallbacks are always PNG.
+        (None, None) on failure
         """
         try:
             if method == "full":
-                return ScreenshotCapture._full_page_capture(driver, path)
+                return ScreenshotCapture._full_page_capture(driver)
             elif method == "smart":
                 # Try full page first if enabled
                 if Config.PREFER_FULL_PAGE:
-                    success = ScreenshotCapture._full_page_capture(driver, path)
-                    if success:
-                        return True
+                    data, fmt = ScreenshotCapture._full_page_capture(driver)
+                    if data:
+                        return data, fmt
                 # Fallback to viewport
-                driver.save_screenshot(str(path))
-                return True
+                return driver.get_screenshot_as_base64(), "png"
             else:
                 # Simple viewport capture
-                driver.save_screenshot(str(path))
-                return True
+                return driver.get_screenshot_as_base64(), "png"
                
-        except Exception as e:
+        except WebDriverException as e:
             logger.error(f"Screenshot capture failed: {e}")
             # Fallback to basic screenshot
             try:
-                driver.save_screenshot(str(path))
-                return True
-            except:
-                return False
+                return driver.get_screenshot_as_base64(), "png"
+            except WebDriverException as e:
+                logger.debug(f"Viewport fallback capture failed: {e}")
+                return None, None
    
     @staticmethod
-    def _full_page_capture(driver, path):
+    def _full_page_capture(driver):
         """IMPROVED: Better full-page capture using CDP"""
         try:
-            # Get dimensions
-            total_height = driver.execute_script("return Math.max(document.body.scrollHeight, document.body.offsetHeight, document.documentElement.clientHeight, document.documentElement.scrollHeight, document.documentElement.offsetHeight);")
-            viewport_height = driver.execute_script("return window.innerHeight")
-            viewport_width = driver.execute_script("return window.innerWidth")
+            # Get dimensions (one round-trip)
+            total_height, viewport_height, viewport_width = driver.execute_script(
+                "const d=document,e=d.documentElement,b=d.body; "
+                "return [Math.max(b.scrollHeight,b.offsetHeight,e.clientHeight,e.scrollHeight,e.offsetHeight), "
+                "window.innerHeight, window.innerWidth];"
+            )
            
             # If page is short, just take viewport
             if total_height <= viewport_height * 1.2:
-                driver.save_screenshot(str(path))
-                return True
+                return driver.get_screenshot_as_base64(), "png"
            
-            # For long pages, use CDP
+            # For long pages, use CDP. captureBeyondViewport + clip renders the
+            # whole document without overriding device metrics (which would force
+            # two extra relayouts per shot)
             try:
-                # Set device metrics to full page size
-                driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", {
-                    "width": viewport_width,
-                    "height": total_height,
-                    "deviceScaleFactor": 1,
-                    "mobile": False
-                })
-               
-                # Capture full screenshot
-                res = driver.execute_cdp_cmd("Page.captureScreenshot", {
-                    "format": "png",
-                    "captureBeyondViewport": True
-                })
-               
-                # Reset metrics
-                driver.execute_cdp_cmd("Emulation.clearDeviceMetricsOverride", {})
-               
-                # Save the full page image
-                with open(path, "wb") as f:
-                    f.write(base64.b64decode(res['data']))
+                params = {
+                    "format": Config.SCREENSHOT_FORMAT,
+                    "captureBeyondViewport": True,
+                    "clip": {
+                        "x": 0,
+                        "y": 0,
+                        "width": viewport_width,
+                        "height": total_height,
+                        "scale": 1
+                    }
+                }
+                if Config.SCREENSHOT_FORMAT != "png":
+                    params["quality"] = Config.SCREENSHOT_QUALITY
+                res = driver.execute_cdp_cmd("Page.captureScreenshot", params)
                
                 logger.info(f"[Full Page] Captured full page screenshot: {total_height}px height")
-                return True
+                return res['data'], Config.SCREENSHOT_FORMAT
                
-            except Exception as cdp_e:
+            except WebDriverException as cdp_e:
                 logger.warning(f"CDP full capture failed: {cdp_e}, falling back to viewport")
-                driver.save_screenshot(str(path))
-                return True
+                return driver.get_screenshot_as_base64(), "png"
                
-        except Exception as e:
+        except (WebDriverException, TypeError, ValueError) as e:
+            # TypeError/ValueError: the dimensions script returned something unexpected
             logger.error(f"Full page capture failed: {e}")
-            return False
+            return None, None
 
 class AutoDocEngine:
     def __init__(self, project_name, output_dir, gemini_api_key=None):
         self.project_name = project_name
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        # Screenshot paths are built as plain strings in the capture loop
+        self._out_str = str(self.output_dir)
         self.gemini_api_key = gemini_api_key
+        # Reused across run_web_exploration calls; see _get_or_create_driver
+        self._driver = None
+        # Numbers each run_web_exploration call, so a reused engine's runs don't
+        # overwrite each other's screenshots (and heatmaps, named after them)
+        self._run_count = 0
+        # Screenshot decode + disk writes overlap with the next click/navigation
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        # Feature matching state, built on first use and reused for every comparison
+        self._orb = None
+        self._bf = None
+        self._orb_features = {}
         
         # Setup logging
         logging.basicConfig(
@@ -372,13 +457,14 @@ class AutoDocEngine:
         
         # Initialize Gemini
         if self.gemini_api_key:
-            genai.configure(api_key=self.gemini_api_key)
             self.model = self._init_gemini()
         else:
             self.model = None
             logger.warning("No Gemini API key provided. AI features will be disabled.")
 
     def _init_gemini(self):
+        import google.generativeai as genai
+        genai.configure(api_key=self.gemini_api_key)
         models = ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-pro"]
         for model_name in models:
             try:
@@ -398,21 +484,13 @@ class AutoDocEngine:
             
         logger.info(f"[Web] Exploring Web App: {url}")
         
-        driver = None
-        browsers = BrowserManager.get_available_browsers()
-        
-        for browser in browsers:
-            try:
-                driver = BrowserManager.create_driver(browser)
-                break
-            except:
-                continue
-        
-        if not driver:
-            raise Exception("Could not initialize any browser")
+        driver = self._get_or_create_driver()
+        self._run_count += 1
+        prefix = f"{self._out_str}/run_{self._run_count:03d}_"
             
         explorer = DeterministicExplorer()
-        screenshots = []
+        # (future, path) pairs for screenshots still being written by the IO pool
+        pending = []
         
         try:
             # Load page
@@ -432,10 +510,9 @@ class AutoDocEngine:
             
             # Phase 1: Initial full page capture
             logger.info("Phase 1: Initial full page capture")
-            filename = f"screen_{screenshot_count:03d}_initial_full.png"
-            path = self.output_dir / filename
-            if ScreenshotCapture.capture_web_screenshot(driver, path, "full"):
-                screenshots.append(path)
+            data, fmt = ScreenshotCapture.capture_web_screenshot(driver, "full")
+            path = f"{prefix}screen_{screenshot_count:03d}_initial_full.{fmt}"
+            if self._store_screenshot(data, path, pending):
                 screenshot_count += 1
                 logger.info(f" [Screenshot] {screenshot_count}: Initial full page")
             
@@ -447,8 +524,8 @@ class AutoDocEngine:
                 try:
                     driver.execute_script("window.scrollTo(0, 0);")
                     time.sleep(1)
-                except:
-                    pass
+                except WebDriverException as e:
+                    logger.debug(f"Scroll to top failed: {e}")
                 
                 for i in range(Config.MAX_SCREENSHOTS - screenshot_count):
                     element, text = explorer.get_next_interactive_element(driver)
@@ -465,31 +542,206 @@ class AutoDocEngine:
                             element
                         )
                         time.sleep(0.5)
+                        before = driver.execute_script(self.DOM_FINGERPRINT_JS)
                         element.click()
-                        time.sleep(3)
+                        time.sleep(0.5)
+                        if not self._wait_for_dom_change(driver, before):
+                            logger.info(f" [Skip] Clicking '{text}' did not change the page")
+                            continue
+                        time.sleep(Config.SCREENSHOT_DELAY)
                         
                         # Capture result
-                        filename = f"screen_{screenshot_count:03d}_action_{int(time.time())}_full.png"
-                        path = self.output_dir / filename
+                        data, fmt = ScreenshotCapture.capture_web_screenshot(driver, "full")
+                        # Click index keeps names unique and sorted in capture order
+                        path = f"{prefix}screen_{screenshot_count:03d}_action_{i:03d}_full.{fmt}"
                         
-                        if ScreenshotCapture.capture_web_screenshot(driver, path, "full"):
-                            screenshots.append(path)
+                        if self._store_screenshot(data, path, pending):
                             screenshot_count += 1
                             logger.info(f" [Screenshot] {screenshot_count}: Full page after clicking '{text}'")
                             
-                    except Exception as e:
+                    except (StaleElementReferenceException, NoSuchElementException, WebDriverException) as e:
                         logger.warning(f"Failed to interact with '{text}': {e}")
                         continue
                         
         finally:
-            if driver:
-                driver.quit()
+            self._reset_driver(driver)
                 
+        written = []
+        for future, path in pending:
+            try:
+                written.append(future.result())
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed to write screenshot {path}: {e}")
+        screenshots = self._drop_near_duplicates(written)
+        if Config.GENERATE_HEATMAPS:
+            self._write_heatmaps(screenshots)
         return screenshots
 
+    def _write_heatmaps(self, paths):
+        """Write a diff heatmap for each screenshot against the one before it"""
+        import cv2
+        prev = None
+        for path in paths:
+            gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
+                logger.warning(f"Could not read {path} for heatmap")
+                continue
+            if prev is not None:
+                # Pages differ in height; compare the overlapping area
+                h = min(prev.shape[0], gray.shape[0])
+                w = min(prev.shape[1], gray.shape[1])
+                heat = _tiled_diff(prev[:h, :w], gray[:h, :w])
+                stem = os.path.splitext(os.path.basename(path))[0]
+                heat_path = f"{self._out_str}/heatmap_{stem}.png"
+                cv2.imwrite(heat_path, cv2.applyColorMap(heat, cv2.COLORMAP_JET))
+                logger.info(f" [Heatmap] {os.path.basename(heat_path)}")
+            prev = gray
+
+    def _drop_near_duplicates(self, shots):
+        """Remove screenshots whose pHash is within range of an earlier kept shot"""
+        if not shots:
+            return []
+        self._orb_features.clear()
+        distances = _hamming_matrix([_phash(gray) for _, gray in shots])
+        kept = []
+        for i, (path, gray) in enumerate(shots):
+            if any(self._same_page(distances[i, j], path, gray, *shots[j]) for j in kept):
+                logger.info(f" [Dedup] Dropping {os.path.basename(path)}: near-duplicate of an earlier screenshot")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            kept.append(i)
+        return [shots[i][0] for i in kept]
+
+    def _same_page(self, distance, path, gray, other_path, other_gray):
+        if distance < Config.PHASH_DUPLICATE_DISTANCE:
+            return True
+        # Ambiguous range: fall back to feature matching as a tiebreaker
+        if Config.USE_FEATURE_MATCHING and distance <= Config.PHASH_AMBIGUOUS_DISTANCE:
+            return self._orb_match_ratio(path, gray, other_path, other_gray) >= Config.MATCH_CONFIDENCE
+        return False
+
+    def _orb_descriptors(self, path, gray):
+        """ORB descriptors for a screenshot, computed once per path"""
+        if self._orb is None:
+            import cv2
+            self._orb = cv2.ORB_create(nfeatures=500, scaleFactor=1.2, nlevels=4)
+            self._bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+        if path not in self._orb_features:
+            self._orb_features[path] = self._orb.detectAndCompute(gray, None)
+        return self._orb_features[path][1]
+
+    def _orb_match_ratio(self, path_a, gray_a, path_b, gray_b):
+        """Fraction of ORB descriptors that cross-match between two screenshots"""
+        des_a = self._orb_descriptors(path_a, gray_a)
+        des_b = self._orb_descriptors(path_b, gray_b)
+        if des_a is None or des_b is None:
+            return 0.0
+        matches = self._bf.match(des_a, des_b)
+        return len(matches) / min(len(des_a), len(des_b))
+
+    # Cheap page-state fingerprint used to detect clicks that did nothing
+    DOM_FINGERPRINT_JS = (
+        "return [document.documentElement.outerHTML.length, "
+        "document.body.scrollHeight, location.href];"
+    )
+
+    def _wait_for_dom_change(self, driver, before, timeout=None):
+        """Poll the DOM fingerprint until it differs from `before`; False if it never does"""
+        deadline = time.monotonic() + (Config.SCROLL_PAUSE if timeout is None else timeout)
+        while True:
+            try:
+                if driver.execute_script(self.DOM_FINGERPRINT_JS) != before:
+                    return True
+            except WebDriverException:
+                # Script failed mid-navigation, so the page is changing
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.25)
+
+    def _store_screenshot(self, data, path, pending):
+        """Queue a captured screenshot for decode + write; returns False if nothing was captured"""
+        if not data:
+            return False
+        if Config.SAVE_TO_DISK:
+            pending.append((self._io_pool.submit(_decode_and_write, data, path), path))
+        return True
+
+    def _get_or_create_driver(self):
+        """Return the cached driver if it is still alive, otherwise start a new one"""
+        if self._driver is not None:
+            try:
+                if self._driver.session_id:
+                    self._driver.execute_script("return 1")
+                    return self._driver
+            except DRIVER_ERRORS as e:
+                logger.warning(f"Cached browser is unresponsive, restarting: {e}")
+            self._quit_driver()
+
+        for browser in BrowserManager.get_available_browsers():
+            try:
+                self._driver = BrowserManager.create_driver(browser)
+                break
+            except Exception as e:
+                # Not only WebDriverException: driver resolution can fail with
+                # network or filesystem errors too
+                logger.debug(f"Could not start {browser}: {e}")
+                continue
+
+        if not self._driver:
+            raise Exception("Could not initialize any browser")
+        return self._driver
+
+    def _reset_driver(self, driver):
+        """Clear per-URL state so the driver can be reused for the next exploration"""
+        try:
+            # Close any tabs opened by clicks, keep the first one
+            handles = driver.window_handles
+            if not handles:
+                # Every window was closed, e.g. by the page itself; start afresh next time
+                logger.warning("Browser has no window left, it will be restarted")
+                self._quit_driver()
+                return
+            for handle in handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(handles[0])
+            # delete_all_cookies only covers the current domain; through CDP (Edge
+            # and Chrome are both Chromium) every domain's cookies go, as does the
+            # storage of the site that was explored
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            url = urlsplit(driver.current_url)
+            if url.scheme in ("http", "https"):
+                driver.execute_cdp_cmd("Storage.clearDataForOrigin", {
+                    "origin": f"{url.scheme}://{url.netloc}",
+                    "storageTypes": "all",
+                })
+            driver.get("about:blank")
+        except DRIVER_ERRORS as e:
+            logger.warning(f"Failed to reset browser, it will be restarted: {e}")
+            self._quit_driver()
+
+    def _quit_driver(self):
+        if self._driver is not None:
+            try:
+                self._driver.quit()
+            except DRIVER_ERRORS:
+                pass
+            finally:
+                self._driver = None
+
+    def close(self):
+        """Shut down the browser and IO pool held by the engine"""
+        self._quit_driver()
+        self._io_pool.shutdown(wait=True)
+
     def generate_report(self, screenshots):
         # Placeholder for report generation logic from the notebook
         # For now, just logging
         logger.info(f"Generating report for {len(screenshots)} screenshots...")
         # TODO: Implement full PDF/HTML generation logic here
+        # (import reportlab / python-docx inside this method, not at module level)
         pass
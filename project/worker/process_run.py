@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 """
 Worker: process_run.py
-- Polls Supabase `runs` table for `pending` runs (or take `--run-id` argument)
+- Listens for `pending` runs via Supabase Realtime (or take `--run-id` argument)
 - Uses Playwright to capture a live screenshot of the project's URL
 - Compares a documentation image (from Supabase Storage `doc_images` or `docs` bucket)
   with the live screenshot using SSIM (skimage) and OpenCV utilities
@@ -14,21 +14,31 @@ Notes:
   SUPABASE_SERVICE_ROLE_KEY  # required for inserts/uploads
   DOCS_BUCKET_NAME (optional, defaults to 'doc_images')
   LIVE_BUCKET_NAME (optional, defaults to 'live_screenshots')
+  SUPABASE_PG_DSN_POOLER (optional, Postgres DSN of the Supabase connection pooler;
+    when set, run/comparison writes go over pooled connections instead of REST)
 
 Run: python process_run.py --run-id <uuid>
-Or run without args to poll once and process the first pending run.
+Or run without args to process pending runs as they are created.
 """
 
 import os
 import io
 import sys
 import time
+import asyncio
+import queue
+import threading
 import argparse
+import hashlib
 import tempfile
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from supabase import create_client
+from supabase import create_client, acreate_client
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import cv2
 from playwright.sync_api import sync_playwright
@@ -40,8 +50,9 @@ SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
 DOCS_BUCKET = os.getenv('DOCS_BUCKET_NAME', 'doc_images')
 LIVE_BUCKET = os.getenv('LIVE_BUCKET_NAME', 'live_screenshots')
-POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', '5'))
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+# Optional Postgres DSN (Supabase pooler) for hot-path writes; REST is used when unset
+SUPABASE_PG_DSN_POOLER = os.getenv('SUPABASE_PG_DSN_POOLER')
 
 if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     print('Missing SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY in environment', file=sys.stderr)
@@ -55,19 +66,156 @@ if not GEMINI_API_KEY:
 
 supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
 
+# Shared keep-alive session for plain HTTP downloads (doc image and public storage URLs)
+HTTP_TIMEOUT = (5, 30)  # (connect, read) seconds
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                       max_retries=Retry(total=3, backoff_factor=0.3))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
+# Public URLs of screenshots this worker already uploaded, keyed by
+# (bucket, content-addressed path); see upload_live_screenshot_once
+LIVE_URL_CACHE_SIZE = 1024
+_live_url_cache = OrderedDict()  # least recently used first
+_live_url_cache_lock = threading.Lock()  # finish_run runs on several consumer threads
+
+# Pooled Postgres connections for run/comparison writes, opened on first use; see db_insert
+PG_POOL_MIN_SIZE = 2
+PG_POOL_MAX_SIZE = 8
+_pg_pool = None
+_pg_pool_lock = threading.Lock()
+
+# Listener pipeline: captured runs waiting for comparison, and the threads comparing them
+RUN_QUEUE_SIZE = 4
+RUN_CONSUMERS = max(1, (os.cpu_count() or 2) // 2)
+
+# How often the listener checks its Realtime connection, and how long it may stay
+# down (the client retries with backoff) before the worker exits to be restarted
+REALTIME_CHECK_INTERVAL = 10
+REALTIME_DOWN_GRACE = 60
+
+# One Chromium is launched on first use and shared by every run; see get_browser
+BROWSER_ARGS = ['--disable-dev-shm-usage', '--no-sandbox']
+_playwright = None
+_browser = None
+_browser_lock = threading.Lock()
+
+# Doc images are downloaded in parallel before the browser loop starts
+DOC_FETCH_WORKERS = 8
+# Live screenshots are JPEG at this quality, unless the project's tolerance is
+# above LOSSLESS_TOLERANCE (percent). An unchanged text-heavy page scores about
+# 99.7-99.8 against its own PNG at q95 (only ~98.7 at q85), so this keeps JPEG
+# noise well clear of the threshold
+SCREENSHOT_QUALITY = 95
+LOSSLESS_TOLERANCE = 99.0
+
+# Concurrent Gemini requests when analysing a doc image's changed regions
+GEMINI_WORKERS = 4
+
+# Short, mostly deterministic descriptions of each changed region
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+GEMINI_GENERATION_CONFIG = {'temperature': 0.2, 'max_output_tokens': 128}
+REGION_PROMPT = [
+    "Analyze the two images provided. The first is a region of the 'documentation image' and the second is the same region of the 'live screenshot'.",
+    "Identify and describe the visual differences between them: changes in layout, text, colors, or presence/absence of elements.",
+    "Provide a concise description of the most prominent change you observe."
+]
+
     # Configure Gemini API
 gemini_model = None
 if GEMINI_API_KEY:
         try:
             genai.configure(api_key=GEMINI_API_KEY)
-            # Use 'gemini-pro' as a more general model, 'gemini-pro-vision' might be regional or specific
-            gemini_model = genai.GenerativeModel('gemini-pro') 
-            print("[DEBUG] Gemini model 'gemini-pro' initialized successfully.")
+            # 'gemini-pro' is text-only and rejects the region images; 1.5 Flash is multimodal
+            gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME, generation_config=GEMINI_GENERATION_CONFIG)
+            print(f"[DEBUG] Gemini model '{GEMINI_MODEL_NAME}' initialized successfully.")
         except Exception as e:
-            print(f"[ERROR] Failed to initialize Gemini model 'gemini-pro': {e}", file=sys.stderr)
+            print(f"[ERROR] Failed to initialize Gemini model '{GEMINI_MODEL_NAME}': {e}", file=sys.stderr)
             gemini_model = None
 
 
+def upload_live_screenshot_once(bucket: str, data: bytes, ext: str, content_type: str) -> tuple:
+    """
+    Upload to a content-addressed path, runs/_cas/<blake2b>.<ext>, and return
+    (path, public URL). A screenshot identical to one already uploaded by this
+    worker is not sent again; across workers the upsert keeps it idempotent.
+    """
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    path = f'runs/_cas/{digest}{ext}'
+    key = (bucket, path)
+    with _live_url_cache_lock:
+        url = _live_url_cache.get(key)
+        if url:
+            _live_url_cache.move_to_end(key)
+    if url:
+        print(f"[DEBUG] Live screenshot unchanged since an earlier upload, reusing '{path}'")
+        return path, url
+
+    # Not under the lock: two threads may both upload the same bytes, which the upsert makes harmless
+    url = upload_live_screenshot(bucket, path, data, content_type, upsert=True)
+    if url:
+        with _live_url_cache_lock:
+            _live_url_cache[key] = url
+            _live_url_cache.move_to_end(key)
+            if len(_live_url_cache) > LIVE_URL_CACHE_SIZE:
+                _live_url_cache.popitem(last=False)  # least recently used
+    return path, url
+
+
+def get_pg_pool():
+    """
+    The shared psycopg connection pool, or None when SUPABASE_PG_DSN_POOLER is
+    unset. psycopg is only imported when a DSN is configured.
+    """
+    global _pg_pool
+    if not SUPABASE_PG_DSN_POOLER:
+        return None
+    with _pg_pool_lock:
+        if _pg_pool is None:
+            from psycopg.rows import dict_row
+            from psycopg_pool import ConnectionPool
+            # prepare_threshold=None: the pooler may hand each statement a different backend
+            _pg_pool = ConnectionPool(SUPABASE_PG_DSN_POOLER, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+                                      kwargs={'row_factory': dict_row, 'prepare_threshold': None, 'autocommit': True})
+        return _pg_pool
+
+
+def db_insert(table: str, rows: list) -> list:
+    """Insert rows (dicts with the same keys) in one statement and return the inserted rows"""
+    pool = get_pg_pool()
+    if pool is None:
+        res = supabase.table(table).insert(rows).execute()
+        return res.data if isinstance(res.data, list) else ([res.data] if res.data else [])
+
+    from psycopg import sql
+    from psycopg.types.json import Jsonb
+    columns = list(rows[0])
+    query = sql.SQL('INSERT INTO {} ({}) VALUES {} RETURNING *').format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(map(sql.Identifier, columns)),
+        sql.SQL(', ').join(sql.SQL('({})').format(sql.SQL(', ').join(sql.Placeholder() * len(columns)))
+                           for _ in rows))
+    params = [Jsonb(row[c]) if isinstance(row[c], (dict, list)) else row[c] for row in rows for c in columns]
+    with pool.connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def db_update(table: str, values: dict, row_id) -> None:
+    """UPDATE table SET values WHERE id = row_id"""
+    pool = get_pg_pool()
+    if pool is None:
+        supabase.table(table).update(values).eq('id', row_id).execute()
+        return
+
+    from psycopg import sql
+    query = sql.SQL('UPDATE {} SET {} WHERE id = %s').format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(sql.SQL('{} = %s').format(sql.Identifier(c)) for c in values))
+    with pool.connection() as conn:
+        conn.execute(query, [*values.values(), row_id])
+
+
 def download_storage_file(bucket: str, path: str) -> bytes | None:
     print(f"[DEBUG] Attempting to download '{path}' from bucket '{bucket}'")
     try:
@@ -86,7 +234,7 @@ def download_storage_file(bucket: str, path: str) -> bytes | None:
             public_url = url_data.get('publicUrl') if isinstance(url_data, dict) else url_data # Handle both dict and direct string return
             if public_url:
                 print(f"[DEBUG] Public URL for '{path}': {public_url}")
-                r = requests.get(public_url)
+                r = SESSION.get(public_url, timeout=HTTP_TIMEOUT)
                 if r.status_code == 200:
                     print(f"[DEBUG] Successfully downloaded '{path}' via public URL.")
                     return r.content
@@ -99,10 +247,14 @@ def download_storage_file(bucket: str, path: str) -> bytes | None:
     return None
 
 
-def upload_live_screenshot(bucket: str, dest_path: str, data: bytes) -> str | None:
+def upload_live_screenshot(bucket: str, dest_path: str, data: bytes, content_type: str = 'image/png',
+                           upsert: bool = False) -> str | None:
     print(f"[DEBUG] Attempting to upload screenshot to '{bucket}/{dest_path}'")
+    file_options = {'content-type': content_type}
+    if upsert:
+        file_options['upsert'] = 'true'
     try:
-        upload_res = supabase.storage.from_(bucket).upload(dest_path, data, {'content-type': 'image/png'})
+        upload_res = supabase.storage.from_(bucket).upload(dest_path, data, file_options)
         print(f"[DEBUG] Supabase upload response: {upload_res}")
         # Check for specific error structure from supabase-py
         if isinstance(upload_res, dict) and 'error' in upload_res:
@@ -135,62 +287,180 @@ def upload_live_screenshot(bucket: str, dest_path: str, data: bytes) -> str | No
     return None
 
 
-def _bytes_to_rgb_array(img_bytes: bytes):
-    # Decode image bytes to OpenCV BGR array then convert to RGB
-    arr = np.frombuffer(img_bytes, np.uint8)
-    bgr = cv2.imdecode(arr, cv2.IMREAD_COLOR)
-    if bgr is None:
+# 1D Gaussian for SSIM (11 taps, sigma 1.5), applied separably along rows and columns
+SSIM_KERNEL_1D = cv2.getGaussianKernel(11, 1.5).astype(np.float32)
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# Run the SSIM map through OpenCV's T-API (OpenCL) when a device is available
+USE_OPENCL = cv2.ocl.haveOpenCL()
+
+# Prefer CUDA when OpenCV was built with it and a GPU is present; intermediates
+# then stay in device memory and only the score (or the map, for regions) is copied back
+USE_CUDA = hasattr(cv2, 'cuda') and cv2.cuda.getCudaEnabledDeviceCount() > 0
+# cv2.cuda filter objects keep internal buffers, so each thread gets its own; see _cuda_gaussian
+_cuda_local = threading.local()
+
+# Prefilter thresholds (grey levels, at quarter scale) below which two images
+# count as identical and SSIM is skipped; the max catches small localised changes
+IDENTICAL_MEAN_DIFF = 0.5
+IDENTICAL_MAX_DIFF = 8
+
+# Global offset correction before SSIM: phase-correlation peaks weaker than
+# ALIGN_MIN_RESPONSE, or shifts beyond ALIGN_MAX_SHIFT pixels, are not applied
+ALIGN_MIN_RESPONSE = 0.1
+ALIGN_MAX_SHIFT = 64
+# Rows of the full-resolution band used to refine the quarter-scale offset, and
+# the largest correction it may make (the coarse estimate is off by a few pixels)
+ALIGN_REFINE_BAND = 1024
+ALIGN_REFINE_MAX = 8
+
+# Pixels of context around each changed region in the crops sent to Gemini
+REGION_CROP_PAD = 16
+
+
+def _gaussian(img):
+    return cv2.sepFilter2D(img, cv2.CV_32F, SSIM_KERNEL_1D, SSIM_KERNEL_1D)
+
+
+def _bytes_to_gray_array(img_bytes: bytes):
+    # SSIM only needs luminance: decode straight to one channel, skipping the
+    # 3-channel buffer and both colour conversions
+    gray = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError('Could not decode image bytes')
+    return gray
+
+
+def _bytes_to_bgr_array(img_bytes: bytes):
+    img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
         raise ValueError('Could not decode image bytes')
-    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-    return rgb
+    return img
 
 
-def compute_ssim_and_diff(img1_bytes: bytes, img2_bytes: bytes):
+def _fit_frame(img, w: int, h: int, offset=None):
+    """img resized to (w, h) and, given a (dx, dy) offset, shifted back by it"""
+    if img.shape[:2] != (h, w):
+        img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+    if offset is None:
+        return img
+    dx, dy = offset
+    shift = np.float32([[1, 0, -dx], [0, 1, -dy]])
+    return cv2.warpAffine(img, shift, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+
+def _region_crop_pngs(doc_img, live_img, regions: list, doc_offset=None, pad: int = REGION_CROP_PAD):
     """
-    Compute SSIM between two images (bytes) using OpenCV and return
-    (similarity_percent, regions, diff_image_bytes)
+    PNG-encoded (doc, live) crops of each region, padded by `pad` pixels.
+    Regions come from the SSIM map, where both images were resized to their
+    smallest common size and the doc image shifted by the offset found when
+    aligning it, so the crops are cut from that same frame.
+    """
+    h = min(doc_img.shape[0], live_img.shape[0])
+    w = min(doc_img.shape[1], live_img.shape[1])
+    frames = [_fit_frame(doc_img, w, h, doc_offset), _fit_frame(live_img, w, h)]
+
+    crops = []
+    for reg in regions:
+        x0 = max(0, reg['x'] - pad)
+        y0 = max(0, reg['y'] - pad)
+        x1 = min(w, reg['x'] + reg['width'] + pad)
+        y1 = min(h, reg['y'] + reg['height'] + pad)
+        crops.append(tuple(cv2.imencode('.png', frame[y0:y1, x0:x1])[1].tobytes() for frame in frames))
+    return crops
+
+
+def _ssim_side(gray_u8, w: int, h: int):
+    """
+    Resize one 8-bit grayscale image to (w, h) and compute its own SSIM terms:
+    (gray, mu, mu_sq, sigma_sq). With OpenCL the terms are cv2.UMat so the
+    blurs and arithmetic stay on the device; cv2 arithmetic works on both.
     """
-    img1_arr = _bytes_to_rgb_array(img1_bytes)
-    img2_arr = _bytes_to_rgb_array(img2_bytes)
+    gray = cv2.resize(gray_u8, (w, h), interpolation=cv2.INTER_AREA).astype(np.float32)
+    if USE_CUDA:
+        return _ssim_side_cuda(gray)
+    if USE_OPENCL:
+        gray = cv2.UMat(gray)
+    # Gaussian-weighted mean and variance (separable 11x11, sigma 1.5)
+    mu = _gaussian(gray)
+    mu_sq = cv2.multiply(mu, mu)
+    sigma_sq = cv2.subtract(_gaussian(cv2.multiply(gray, gray)), mu_sq)
+    return gray, mu, mu_sq, sigma_sq
+
+
+def _cuda_gaussian():
+    """This thread's 11x11, sigma 1.5 Gaussian filter for CV_32FC1 GpuMats"""
+    if not hasattr(_cuda_local, 'gaussian'):
+        _cuda_local.gaussian = cv2.cuda.createGaussianFilter(cv2.CV_32FC1, cv2.CV_32FC1, (11, 11), 1.5)
+    return _cuda_local.gaussian
+
 
-    # Resize to smallest common size
-    h1, w1 = img1_arr.shape[:2]
-    h2, w2 = img2_arr.shape[:2]
-    w = min(w1, w2)
-    h = min(h1, h2)
-    img1_resized = cv2.resize(img1_arr, (w, h), interpolation=cv2.INTER_AREA)
-    img2_resized = cv2.resize(img2_arr, (w, h), interpolation=cv2.INTER_AREA)
+def _ssim_side_cuda(gray):
+    """_ssim_side terms as cv2.cuda_GpuMat, computed on the GPU"""
+    g = cv2.cuda_GpuMat()
+    g.upload(gray)
+    mu = _cuda_gaussian().apply(g)
+    mu_sq = cv2.cuda.multiply(mu, mu)
+    sigma_sq = cv2.cuda.subtract(_cuda_gaussian().apply(cv2.cuda.multiply(g, g)), mu_sq)
+    return g, mu, mu_sq, sigma_sq
 
-    # Convert to grayscale
-    gray1 = cv2.cvtColor(img1_resized, cv2.COLOR_RGB2GRAY).astype(np.float32)
-    gray2 = cv2.cvtColor(img2_resized, cv2.COLOR_RGB2GRAY).astype(np.float32)
 
-    # --- SSIM implementation (from standard formula) ---
-    C1 = (0.01 * 255) ** 2
-    C2 = (0.03 * 255) ** 2
+def _ssim_map_cuda(side1, side2):
+    """_ssim_map for two _ssim_side_cuda results; the map stays on the GPU"""
+    gray1, mu1, mu1_sq, sigma1_sq = side1
+    gray2, mu2, mu2_sq, sigma2_sq = side2
 
-    # Gaussian kernel for mean and variance
-    kernel = (11, 11)
-    sigma = 1.5
+    mu1_mu2 = cv2.cuda.multiply(mu1, mu2)
+    sigma12 = cv2.cuda.subtract(_cuda_gaussian().apply(cv2.cuda.multiply(gray1, gray2)), mu1_mu2)
 
-    mu1 = cv2.GaussianBlur(gray1, kernel, sigma)
-    mu2 = cv2.GaussianBlur(gray2, kernel, sigma)
+    num = cv2.cuda.multiply(cv2.cuda.addWeighted(mu1_mu2, 2.0, mu1_mu2, 0.0, SSIM_C1),
+                            cv2.cuda.addWeighted(sigma12, 2.0, sigma12, 0.0, SSIM_C2))
+    den = cv2.cuda.multiply(cv2.cuda.addWeighted(mu1_sq, 1.0, mu2_sq, 1.0, SSIM_C1),
+                            cv2.cuda.addWeighted(sigma1_sq, 1.0, sigma2_sq, 1.0, SSIM_C2))
+    return cv2.cuda.divide(num, den)
 
-    mu1_sq = mu1 * mu1
-    mu2_sq = mu2 * mu2
-    mu1_mu2 = mu1 * mu2
 
-    sigma1_sq = cv2.GaussianBlur(gray1 * gray1, kernel, sigma) - mu1_sq
-    sigma2_sq = cv2.GaussianBlur(gray2 * gray2, kernel, sigma) - mu2_sq
-    sigma12 = cv2.GaussianBlur(gray1 * gray2, kernel, sigma) - mu1_mu2
+def _map_mean(ssim_map) -> float:
+    """Mean of an SSIM map without copying it off the device"""
+    if USE_CUDA:
+        w, h = ssim_map.size()
+        return cv2.cuda.sum(ssim_map)[0] / (w * h)
+    return cv2.mean(ssim_map)[0]
 
-    # SSIM map
-    num = (2 * mu1_mu2 + C1) * (2 * sigma12 + C2)
-    den = (mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2)
-    ssim_map = np.divide(num, den, out=np.zeros_like(num), where=den != 0)
 
-    score = float(np.mean(ssim_map))
+def _to_host(ssim_map):
+    if USE_CUDA:
+        return ssim_map.download()
+    if isinstance(ssim_map, cv2.UMat):
+        return ssim_map.get()
+    return ssim_map
 
+
+def _ssim_map(side1, side2):
+    """
+    SSIM map (standard formula) from two _ssim_side results of equal size.
+    Stays wherever the terms live (ndarray, UMat or GpuMat); see _to_host
+    """
+    if USE_CUDA:
+        return _ssim_map_cuda(side1, side2)
+    gray1, mu1, mu1_sq, sigma1_sq = side1
+    gray2, mu2, mu2_sq, sigma2_sq = side2
+
+    mu1_mu2 = cv2.multiply(mu1, mu2)
+    sigma12 = cv2.subtract(_gaussian(cv2.multiply(gray1, gray2)), mu1_mu2)
+
+    # addWeighted(a, alpha, b, beta, gamma) = alpha*a + beta*b + gamma
+    num = cv2.multiply(cv2.addWeighted(mu1_mu2, 2.0, mu1_mu2, 0.0, SSIM_C1),
+                       cv2.addWeighted(sigma12, 2.0, sigma12, 0.0, SSIM_C2))
+    den = cv2.multiply(cv2.addWeighted(mu1_sq, 1.0, mu2_sq, 1.0, SSIM_C1),
+                       cv2.addWeighted(sigma1_sq, 1.0, sigma2_sq, 1.0, SSIM_C2))
+    # cv2.divide yields 0 where den == 0
+    return cv2.divide(num, den)
+
+
+def _regions_and_diff(ssim_map, want_diff: bool = False):
+    """Changed regions (bounding boxes) for an SSIM map, and its PNG diff image if want_diff"""
     # produce diff image (normalize 0..255)
     diff = (1.0 - ssim_map)  # higher where different
     diff_norm = (np.clip(diff, 0.0, 1.0) * 255.0).astype('uint8')
@@ -199,30 +469,281 @@ def compute_ssim_and_diff(img1_bytes: bytes, img2_bytes: bytes):
     _, thresh = cv2.threshold(diff_norm, 30, 255, cv2.THRESH_BINARY)
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-    regions = []
-    for cnt in contours:
-        x, y, wbox, hbox = cv2.boundingRect(cnt)
-        area = wbox * hbox
-        if area < 50:
-            continue
-        regions.append({'x': int(x), 'y': int(y), 'width': int(wbox), 'height': int(hbox), 'area': int(area)})
+    # Filter all bounding boxes as one array; dicts are only built for the kept ones
+    rects = np.array([cv2.boundingRect(cnt) for cnt in contours], dtype=np.int32).reshape(-1, 4)
+    areas = rects[:, 2] * rects[:, 3]
+    keep = areas >= 50
+
+    # tolist() yields plain ints, ready for JSON
+    regions = [{'x': x, 'y': y, 'width': wbox, 'height': hbox, 'area': area}
+               for (x, y, wbox, hbox), area in zip(rects[keep].tolist(), areas[keep].tolist())]
+
+    if not want_diff:
+        return regions, None
 
     # encode diff image to PNG bytes for optional use
     diff_bgr = cv2.cvtColor(diff_norm, cv2.COLOR_GRAY2BGR)
     is_success, buffer = cv2.imencode('.png', diff_bgr)
     diff_bytes = buffer.tobytes() if is_success else None
+    return regions, diff_bytes
+
+
+class SSIMReference:
+    """
+    An image that will be compared against several others. It is decoded once,
+    and its SSIM terms (gray, mu, mu^2, sigma^2) are cached per comparison size,
+    so each compare() only blurs the other image and the cross term.
+    """
+
+    def __init__(self, ref_bytes: bytes):
+        self.gray = _bytes_to_gray_array(ref_bytes)
+        self._sides = {}  # (w, h) -> _ssim_side result, or its half-precision planes
+        self._smalls = {}  # quarter size -> quarter-scale copy, for the prefilter and alignment
+
+    def _side(self, w: int, h: int):
+        if (w, h) not in self._sides:
+            side = _ssim_side(self.gray, w, h)
+            if isinstance(side[0], np.ndarray):
+                # Host-side terms are cached compactly: 7 bytes per pixel instead of 16.
+                # gray holds whole numbers 0..255, so uint8 is exact. sigma^2 only
+                # enters the denominator, where float16's 3 digits are plenty. mu
+                # stays float32 because sigma12 = blur(g1*g2) - mu1*mu2 cancels,
+                # and mu^2 is recomputed from it
+                gray, mu, _, sigma_sq = side
+                side = (gray.astype(np.uint8), mu, sigma_sq.astype(np.float16))
+            self._sides[(w, h)] = side
+        side = self._sides[(w, h)]
+        if len(side) == 3:
+            # Arithmetic stays in float32: OpenCV filters have no CV_16F path
+            # and numpy's float16 math is emulated on the CPU
+            gray, mu, sigma_sq = side
+            return gray.astype(np.float32), mu, cv2.multiply(mu, mu), sigma_sq.astype(np.float32)
+        return side
+
+    def _common_size(self, other):
+        # Resize to smallest common size
+        h1, w1 = self.gray.shape[:2]
+        h2, w2 = other.shape[:2]
+        return min(w1, w2), min(h1, h2)
+
+    def _quarter(self, other, w: int, h: int):
+        """Quarter-scale copies of this image (cached) and `other`, for common size (w, h)"""
+        size = (max(1, w // 4), max(1, h // 4))
+        if size not in self._smalls:
+            self._smalls[size] = cv2.resize(self.gray, size, interpolation=cv2.INTER_AREA)
+        return self._smalls[size], cv2.resize(other, size, interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def _looks_identical(small1, small2) -> bool:
+        """
+        Cheap prefilter run before SSIM: at quarter scale the two images differ
+        by well under one grey level on average and nowhere by much, so SSIM
+        would find no region to report
+        """
+        diff = cv2.absdiff(small1, small2)
+        return cv2.mean(diff)[0] < IDENTICAL_MEAN_DIFF and int(diff.max()) <= IDENTICAL_MAX_DIFF
+
+    @staticmethod
+    def _offset(small1, small2, w: int, h: int):
+        """
+        Global (dx, dy) offset of the other image at common size (w, h), when the
+        whole page has moved (e.g. a banner pushed the content down), or None.
+        It comes from phase correlation of the quarter-scale copies; weak peaks
+        and implausibly large shifts are ignored. The estimate is only good to a
+        few pixels (text is mostly detail finer than the quarter-scale grid), so
+        _refine_offset corrects it at full resolution.
+        """
+        if min(small1.shape) < 2:
+            return None
+        window = cv2.createHanningWindow(small1.shape[::-1], cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(np.float32(small1), np.float32(small2), window)
+        dx *= w / small1.shape[1]
+        dy *= h / small1.shape[0]
+        if response < ALIGN_MIN_RESPONSE or abs(dx) + abs(dy) < 1 or max(abs(dx), abs(dy)) > ALIGN_MAX_SHIFT:
+            return None
+        return dx, dy
+
+    def _refine_offset(self, other, w: int, h: int, offset):
+        """
+        offset corrected by phase correlation at full resolution, on a band of
+        ALIGN_REFINE_BAND rows through the middle of the page after undoing the
+        coarse shift. Keeps the coarse offset if the band gives no clear peak.
+        """
+        ref = self.gray if self.gray.shape[:2] == (h, w) else cv2.resize(self.gray, (w, h), interpolation=cv2.INTER_AREA)
+        dx, dy = round(offset[0]), round(offset[1])
+        moved = _fit_frame(other, w, h, (dx, dy))
+        top = max(0, (h - ALIGN_REFINE_BAND) // 2)
+        band1 = np.float32(ref[top:top + ALIGN_REFINE_BAND])
+        band2 = np.float32(moved[top:top + ALIGN_REFINE_BAND])
+        if min(band1.shape) < 2:
+            return offset
+        window = cv2.createHanningWindow(band1.shape[::-1], cv2.CV_32F)
+        (rx, ry), response = cv2.phaseCorrelate(band1, band2, window)
+        if response < ALIGN_MIN_RESPONSE or max(abs(rx), abs(ry)) > ALIGN_REFINE_MAX:
+            return offset
+        return dx + rx, dy + ry
+
+    def compare(self, other_bytes: bytes, need_diff_map: bool = False, diff_below: float | None = None,
+                want_diff: bool = False):
+        """Same contract as compute_ssim_and_diff, with this image as the first one"""
+        return self._compare_gray(_bytes_to_gray_array(other_bytes), need_diff_map, diff_below, want_diff)[:3]
+
+    def _compare_gray(self, other, need_diff_map: bool, diff_below: float | None, want_diff: bool = False):
+        """(similarity_percent, regions, diff_bytes, offset); offset as from _offset"""
+        w, h = self._common_size(other)
+        small1, small2 = self._quarter(other, w, h)
+        if not need_diff_map and self._looks_identical(small1, small2):
+            return 100.0, [], None, None
+        offset = self._offset(small1, small2, w, h)
+        if offset is not None:
+            offset = self._refine_offset(other, w, h, offset)
+        other = _fit_frame(other, w, h, offset)
+        ssim_map = _ssim_map(self._side(w, h), _ssim_side(other, w, h))
+        similarity_percent = float(_map_mean(ssim_map)) * 100.0
+        return _ssim_result(similarity_percent, ssim_map, need_diff_map, diff_below, want_diff) + (offset,)
 
-    similarity_percent = float(score) * 100.0
+    def compare_many(self, others: list, diff_below: float | None = None, want_diff: bool = False) -> list:
+        """
+        compare() against several images, one pair at a time so only one set of
+        full-size temporaries is alive. Returns one (similarity_percent, regions,
+        diff_bytes, offset) per input, or None where the input was missing or
+        could not be decoded. Regions are in the frame of the other image after
+        _fit_frame(img, w, h, offset), which _region_crop_pngs reproduces.
+        """
+        results = [None] * len(others)
+        for i, data in enumerate(others):
+            if not data:
+                continue
+            try:
+                gray = _bytes_to_gray_array(data)
+            except ValueError as e:
+                print(f"[ERROR] Could not decode image {i} for comparison: {e}", file=sys.stderr)
+                continue
+            results[i] = self._compare_gray(gray, False, diff_below, want_diff)
+        return results
+
+
+def _ssim_result(similarity_percent: float, ssim_map, need_diff_map: bool, diff_below: float | None,
+                 want_diff: bool = False):
+    """(similarity_percent, regions, diff_bytes), building regions and the diff only when asked for"""
+    if not need_diff_map and (diff_below is None or similarity_percent >= diff_below):
+        return similarity_percent, [], None
+
+    # Region extraction runs on the CPU; the map is only copied back when needed
+    regions, diff_bytes = _regions_and_diff(_to_host(ssim_map), want_diff)
     return similarity_percent, regions, diff_bytes
 
 
-def process_run_id(run_id: str):
+def compute_ssim_and_diff(img1_bytes: bytes, img2_bytes: bytes, need_diff_map: bool = False,
+                          diff_below: float | None = None, want_diff: bool = False):
+    """
+    Compute SSIM between two images (bytes) using OpenCV and return
+    (similarity_percent, regions, diff_image_bytes)
+
+    Changed regions are only built when need_diff_map is True, or when
+    diff_below is given and the similarity falls under it (pass the project
+    tolerance to get regions for changed pages in a single call); otherwise
+    regions is []. The diff image is PNG-encoded alongside them only if
+    want_diff is True, and is None otherwise.
+    """
+    return SSIMReference(img1_bytes).compare(img2_bytes, need_diff_map, diff_below, want_diff)
+
+
+def fetch_doc_image(doc: dict) -> bytes | None:
+    """Download a documentation image from its URL, or from DOCS_BUCKET by path"""
+    doc_bytes = None
+    if doc.get('url'):
+        try:
+            print(f"[DEBUG] Attempting to download doc image from URL: {doc.get('url')}")
+            r = SESSION.get(doc.get('url'), timeout=HTTP_TIMEOUT)
+            if r.status_code == 200:
+                doc_bytes = r.content
+                print(f"[DEBUG] Downloaded doc image from URL. Size: {len(doc_bytes)} bytes.")
+            else:
+                print(f"[ERROR] Failed to download doc image from URL {doc.get('url')}. Status: {r.status_code}", file=sys.stderr)
+        except Exception as e:
+            print(f"[ERROR] Exception downloading doc image from URL: {e}", file=sys.stderr)
+    else:
+        # try download via bucket
+        try:
+            print(f"[DEBUG] Attempting to download doc image from bucket '{DOCS_BUCKET}', path '{doc['path']}'")
+            maybe = download_storage_file(DOCS_BUCKET, doc['path'])
+            if maybe:
+                if isinstance(maybe, bytes):
+                    doc_bytes = maybe
+                    print(f"[DEBUG] Downloaded doc image from bucket. Size: {len(doc_bytes)} bytes.")
+                else:
+                    # supabase-py returns a Response-like object sometimes
+                    # Assuming this response object contains the bytes
+                    doc_bytes = maybe.content # Access content from the response-like object
+                    print(f"[DEBUG] Downloaded doc image from bucket (response object). Size: {len(doc_bytes)} bytes.")
+            else:
+                print(f"[ERROR] Failed to download doc image from bucket '{DOCS_BUCKET}', path '{doc['path']}'. No data returned.", file=sys.stderr)
+        except Exception as e:
+            print(f"[ERROR] Exception downloading doc image from bucket: {e}", file=sys.stderr)
+    return doc_bytes
+
+
+def analyze_region(reg: dict, crop: tuple) -> str:
+    """Gemini's description of one changed region, given its (doc, live) PNG crops"""
+    try:
+        print(f"[DEBUG] Sending region crops to Gemini for region: {reg}")
+        doc_png, live_png = crop
+        response = gemini_model.generate_content(REGION_PROMPT + [
+            {"mime_type": "image/png", "data": doc_png},
+            {"mime_type": "image/png", "data": live_png},
+        ])
+        print(f"[DEBUG] Gemini analysis for region {reg}: {response.text}")
+        return response.text
+    except Exception as e:
+        print(f"[ERROR] Gemini API analysis failed for region {reg}: {e}", file=sys.stderr)
+        return f"AI analysis failed: {e}"
+
+
+def get_browser():
+    """
+    The long-lived headless Chromium, (re)launched if it isn't running.
+    Playwright's sync objects belong to the thread that started them, so every
+    run must call this from that same thread (listen_for_runs uses one worker thread).
+    """
+    global _playwright, _browser
+    with _browser_lock:
+        if _browser is None or not _browser.is_connected():
+            if _playwright is None:
+                _playwright = sync_playwright().start()
+            print("[DEBUG] Launching Playwright browser.")
+            _browser = _playwright.chromium.launch(headless=True, args=BROWSER_ARGS)
+        return _browser
+
+
+def close_browser():
+    """Shut down the shared browser and Playwright; call from the thread that used them"""
+    global _playwright, _browser
+    with _browser_lock:
+        if _browser is not None:
+            print("[DEBUG] Closing Playwright browser.")
+            try:
+                _browser.close()
+            except Exception:
+                traceback.print_exc()
+        if _playwright is not None:
+            _playwright.stop()
+        _browser = None
+        _playwright = None
+
+
+def capture_run(run_id: str) -> dict | None:
+    """
+    Browser stage of a run: mark it processing, start downloading its doc
+    images and take the live screenshot. Returns the job for finish_run, or
+    None if the run can't be processed. Must run on the Playwright thread.
+    """
     try:
         # fetch run with project
         r = supabase.table('runs').select('*, projects(*)').eq('id', run_id).maybe_single().execute()
         if not r.data:
             print('Run not found', run_id)
-            return
+            return None
         run = r.data
 
         project = run.get('projects')
@@ -232,7 +753,7 @@ def process_run_id(run_id: str):
         print(f"[DEBUG] Retrieved app_url for project: {app_url}")
 
         # mark processing
-        supabase.table('runs').update({'status': 'processing'}).eq('id', run_id).execute()
+        db_update('runs', {'status': 'processing'}, run_id)
 
         # find doc images for this project: look into `documents` table first
         docs_res = supabase.table('documents').select('*').eq('project_id', project_id).execute()
@@ -259,189 +780,199 @@ def process_run_id(run_id: str):
             print('No doc images found, using sample placeholders')
             doc_images = [{'path': 'screenshots/login-page.png', 'url': None}]
 
+        print(f"[DEBUG] Project app_url: {app_url}")
+
+        # Fetch all doc images concurrently; they download while the browser navigates
+        doc_pool = ThreadPoolExecutor(max_workers=DOC_FETCH_WORKERS)
+        doc_futures = [doc_pool.submit(fetch_doc_image, doc) for doc in doc_images]
+        doc_pool.shutdown(wait=False)  # queued downloads still run
+
+        # JPEG is several times smaller to upload and decode; its artifacts only
+        # matter against a near-100% tolerance, where the live shot stays PNG
+        lossless = float(tolerance) > LOSSLESS_TOLERANCE
+        screenshot_ext, screenshot_type = ('.png', 'image/png') if lossless else ('.jpg', 'image/jpeg')
+
+        # Each run gets a fresh context (own cookies and storage) on the shared browser;
+        # it is closed as soon as the screenshot is taken
+        screenshot_bytes = None
+        with get_browser().new_context(viewport={'width': 1280, 'height': 720}) as context:
+            page = context.new_page()
+            # Capture live screenshot for project.app_url once; every doc image
+            # is compared against the same page
+            if app_url:
+                try:
+                    page.goto(app_url, wait_until='networkidle', timeout=30000)
+                    time.sleep(1)
+                    if lossless:
+                        screenshot_bytes = page.screenshot(full_page=True)
+                    else:
+                        screenshot_bytes = page.screenshot(full_page=True, type='jpeg', quality=SCREENSHOT_QUALITY)
+                    print(f"[DEBUG] Playwright captured screenshot. Size: {len(screenshot_bytes) if screenshot_bytes else 0} bytes.")
+                    if not screenshot_bytes:
+                        print("[ERROR] Playwright returned empty screenshot bytes.", file=sys.stderr)
+                except Exception as e:
+                    print('Playwright navigation failed or screenshot error:', e, file=sys.stderr)
+                    screenshot_bytes = None
+            else:
+                print("[DEBUG] No app_url specified, skipping live screenshot capture.")
+
+        return {
+            'run_id': run_id,
+            'tolerance': tolerance,
+            'doc_images': doc_images,
+            'doc_futures': doc_futures,
+            'screenshot_bytes': screenshot_bytes,
+            'screenshot_ext': screenshot_ext,
+            'screenshot_type': screenshot_type,
+        }
+
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+def finish_run(job: dict):
+    """
+    Comparison stage of a run: SSIM, uploads, AI analysis and DB writes for a
+    capture_run job. Uses no browser, so it can run on any thread.
+    """
+    try:
+        run_id = job['run_id']
+        tolerance = job['tolerance']
+        doc_images = job['doc_images']
+        screenshot_bytes = job['screenshot_bytes']
+        screenshot_ext = job['screenshot_ext']
+        screenshot_type = job['screenshot_type']
+
         total_images = 0
         changes_detected = 0
 
-        print(f"[DEBUG] Project app_url: {app_url}")
+        # Decode the live screenshot once; its SSIM terms are reused for every doc image
+        live_ref = None
+        if screenshot_bytes:
+            try:
+                live_ref = SSIMReference(screenshot_bytes)
+            except ValueError as e:
+                print(f"[ERROR] Could not decode live screenshot: {e}", file=sys.stderr)
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page(viewport={'width': 1280, 'height': 720})
+        live_bgr = None  # colour live screenshot, decoded on first use for region crops
 
+        # One upload per distinct screenshot; every doc image's comparison references it
+        live_cas_path, live_url = None, None
+        if screenshot_bytes:
+            live_cas_path, live_url = upload_live_screenshot_once(LIVE_BUCKET, screenshot_bytes,
+                                                                  screenshot_ext, screenshot_type)
+            print(f"[DEBUG] Live screenshot at {live_cas_path}. URL: {live_url}")
+
+        # Score every doc image against the live page; its SSIM terms are computed once
+        doc_bytes_list = [f.result() for f in job['doc_futures']]
+        comparisons = [None] * len(doc_images)
+        if live_ref:
             try:
-                for doc in doc_images:
-                    total_images += 1
-                    filename = os.path.basename(doc['path'])
-
-                    # Capture live screenshot for project.app_url
-                    if app_url:
-                        try:
-                            page.goto(app_url, wait_until='networkidle', timeout=30000)
-                            time.sleep(1)
-                            screenshot_bytes = page.screenshot(full_page=True)
-                            print(f"[DEBUG] Playwright captured screenshot. Size: {len(screenshot_bytes) if screenshot_bytes else 0} bytes.")
-                            if not screenshot_bytes:
-                                print("[ERROR] Playwright returned empty screenshot bytes.", file=sys.stderr)
-                        except Exception as e:
-                            print('Playwright navigation failed or screenshot error:', e, file=sys.stderr)
-                            screenshot_bytes = None
-                    else:
-                        print("[DEBUG] No app_url specified, skipping live screenshot capture.")
-                        screenshot_bytes = None
-
-                    # Download doc image from storage if possible
-                    doc_bytes = None
-                    if doc.get('url'):
-                        try:
-                            print(f"[DEBUG] Attempting to download doc image from URL: {doc.get('url')}")
-                            r = requests.get(doc.get('url'))
-                            if r.status_code == 200:
-                                doc_bytes = r.content
-                                print(f"[DEBUG] Downloaded doc image from URL. Size: {len(doc_bytes)} bytes.")
-                            else:
-                                print(f"[ERROR] Failed to download doc image from URL {doc.get('url')}. Status: {r.status_code}", file=sys.stderr)
-                        except Exception as e:
-                            print(f"[ERROR] Exception downloading doc image from URL: {e}", file=sys.stderr)
-                    else:
-                        # try download via bucket
-                        try:
-                            print(f"[DEBUG] Attempting to download doc image from bucket '{DOCS_BUCKET}', path '{doc['path']}'")
-                            maybe = download_storage_file(DOCS_BUCKET, doc['path'])
-                            if maybe:
-                                if isinstance(maybe, bytes):
-                                    doc_bytes = maybe
-                                    print(f"[DEBUG] Downloaded doc image from bucket. Size: {len(doc_bytes)} bytes.")
-                                else:
-                                    # supabase-py returns a Response-like object sometimes
-                                    # Assuming this response object contains the bytes
-                                    doc_bytes = maybe.content # Access content from the response-like object
-                                    print(f"[DEBUG] Downloaded doc image from bucket (response object). Size: {len(doc_bytes)} bytes.")
-                            else:
-                                print(f"[ERROR] Failed to download doc image from bucket '{DOCS_BUCKET}', path '{doc['path']}'. No data returned.", file=sys.stderr)
-                        except Exception as e:
-                            print(f"[ERROR] Exception downloading doc image from bucket: {e}", file=sys.stderr)
-
-                    # If no doc image, skip comparison and just upload live screenshot
-                    if not doc_bytes:
-                        print("[WARNING] No documentation image found for comparison.", file=sys.stderr)
-
-                    live_path = f'runs/{run_id}/live/{filename}'
-                    live_url = None
-                    if screenshot_bytes:
-                        live_url = upload_live_screenshot(LIVE_BUCKET, live_path, screenshot_bytes)
-                        print(f"[DEBUG] Uploaded live screenshot. Returned URL: {live_url}")
-                    else:
-                        print("[WARNING] No live screenshot bytes available for upload.", file=sys.stderr)
-
-                    similarity = None
-                    regions = []
-                    status = 'error' # Default to error if comparison fails or images are missing
-
-                    print(f"[DEBUG] Before comparison: doc_bytes {'present' if doc_bytes else 'MISSING'}, screenshot_bytes {'present' if screenshot_bytes else 'MISSING'}")
-
-                    if doc_bytes and screenshot_bytes:
-                        try:
-                            similarity, regions, diff = compute_ssim_and_diff(doc_bytes, screenshot_bytes)
-                            status = 'matched' if similarity >= float(tolerance) else 'changed'
-                            if status == 'changed':
-                                changes_detected += 1
-                            print(f"[DEBUG] Comparison completed. Similarity: {similarity:.2f}%, Status: {status}, Changes: {len(regions)} regions.")
-                        except Exception as e:
-                            print(f'[ERROR] Error computing diff: {e}', file=sys.stderr)
-                            similarity = None
-                            status = 'error'
-                    else:
-                        print("[ERROR] Skipping comparison due to missing documentation or live screenshot.", file=sys.stderr)
-                        status = 'error'
-
-                    # Insert comparison
-                    print(f"[DEBUG] Inserting comparison for doc_path: {doc['path']}, live_path: {live_path}, live_url: {live_url}, status: {status}")
-                    comp_insert = {
-                        'run_id': run_id,
-                        'doc_image_path': doc['path'],
-                        'doc_image_url': doc.get('url'),
-                        'live_image_path': live_path,
-                        'live_image_url': live_url,
-                        'similarity_score': float(similarity) if similarity is not None else None,
-                        'status': status,
-                        'change_severity': 'major' if similarity is not None and similarity < 90 else ('minor' if similarity is not None and similarity < tolerance else None),
-                        'processed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-                    }
-
-                    comp_res = supabase.table('comparisons').insert(comp_insert).execute()
-                    # supabase-py v2 returns data as list for inserts
-                    if isinstance(comp_res.data, list):
-                        comp_row = comp_res.data[0] if comp_res.data else None
-                    else:
-                        comp_row = comp_res.data if comp_res.data else None
-
-                    if status == 'changed' and comp_row:
-                        # insert change_details for each region
-                        for reg in regions:
-                            desc = f'Detected change in region area {reg.get("area")}'
-                            gemini_analysis_text = "No AI analysis performed."
-                            if gemini_model and doc_bytes and screenshot_bytes:
-                                try:
-                                    print(f"[DEBUG] Sending images to Gemini for region: {reg}")
-                                    # Prepare images for Gemini
-                                    image_parts = [
-                                        {
-                                            "mime_type": "image/png",
-                                            "data": doc_bytes
-                                        },
-                                        {
-                                            "mime_type": "image/png",
-                                            "data": screenshot_bytes
-                                        }
-                                    ]
-
-                                    # Create a prompt focusing on the detected region
-                                    prompt_content = [
-                                        "Analyze the two images provided. The first image is the 'documentation image' and the second is the 'live screenshot'.",
-                                        "Identify and describe the visual differences between these two images specifically within the bounding box region defined by: ",
-                                        f"X: {reg.get('x')}, Y: {reg.get('y')}, Width: {reg.get('width')}, Height: {reg.get('height')}.",
-                                        "Focus on changes in layout, text, colors, or presence/absence of elements within this specific area.",
-                                        "Provide a concise description of the most prominent change you observe in this region."
-                                    ]
-
-                                    response = gemini_model.generate_content(prompt_content + image_parts)
-                                    gemini_analysis_text = response.text
-                                    print(f"[DEBUG] Gemini analysis for region {reg}: {gemini_analysis_text}")
-                                except Exception as e:
-                                    print(f"[ERROR] Gemini API analysis failed for region {reg}: {e}", file=sys.stderr)
-                                    gemini_analysis_text = f"AI analysis failed: {e}"
-
-                            cd = {
-                                'comparison_id': comp_row.get('id'),
-                                'change_type': 'visual',
-                                'description': desc,
-                                'position_x': reg.get('x'),
-                                'position_y': reg.get('y'),
-                                'width': reg.get('width'),
-                                'height': reg.get('height'),
-                                'severity': 'major' if reg.get('area', 0) > 1000 else 'minor',
-                                'ai_analysis': {
-                                    'confidence': 0.8, 
-                                    'recommendation': 'Review and approve if intended.',
-                                    'gemini_description': gemini_analysis_text
-                                }
-                            }
-                            supabase.table('change_details').insert(cd).execute()
-            finally:
-                if page:
-                    print("[DEBUG] Closing Playwright page.")
-                    page.close()
-                if browser:
-                    print("[DEBUG] Closing Playwright browser.")
-                    browser.close()
+                comparisons = live_ref.compare_many(doc_bytes_list, diff_below=float(tolerance))
+            except Exception as e:
+                print(f'[ERROR] Error computing diffs: {e}', file=sys.stderr)
+
+        for index, doc in enumerate(doc_images):
+            total_images += 1
+            filename = os.path.basename(doc['path'])
+
+            doc_bytes = doc_bytes_list[index]
+
+            # If no doc image, skip comparison and just upload live screenshot
+            if not doc_bytes:
+                print("[WARNING] No documentation image found for comparison.", file=sys.stderr)
+
+            if live_cas_path:
+                live_path = live_cas_path
+            else:
+                live_path = f'runs/{run_id}/live/{os.path.splitext(filename)[0]}{screenshot_ext}'
+                print("[WARNING] No live screenshot bytes available for upload.", file=sys.stderr)
+
+            similarity = None
+            regions = []
+            status = 'error' # Default to error if comparison fails or images are missing
+
+            print(f"[DEBUG] Before comparison: doc_bytes {'present' if doc_bytes else 'MISSING'}, screenshot_bytes {'present' if screenshot_bytes else 'MISSING'}")
+
+            if doc_bytes and live_ref:
+                if comparisons[index] is not None:
+                    similarity, regions, _, doc_offset = comparisons[index]
+                    status = 'matched' if similarity >= float(tolerance) else 'changed'
+                    if status == 'changed':
+                        changes_detected += 1
+                    print(f"[DEBUG] Comparison completed. Similarity: {similarity:.2f}%, Status: {status}, Changes: {len(regions)} regions.")
+                else:
+                    print('[ERROR] Error computing diff for this image.', file=sys.stderr)
+                    status = 'error'
+            else:
+                print("[ERROR] Skipping comparison due to missing documentation or live screenshot.", file=sys.stderr)
+                status = 'error'
+
+            # Insert comparison
+            print(f"[DEBUG] Inserting comparison for doc_path: {doc['path']}, live_path: {live_path}, live_url: {live_url}, status: {status}")
+            comp_insert = {
+                'run_id': run_id,
+                'doc_image_path': doc['path'],
+                'doc_image_url': doc.get('url'),
+                'live_image_path': live_path,
+                'live_image_url': live_url,
+                'similarity_score': float(similarity) if similarity is not None else None,
+                'status': status,
+                'change_severity': 'major' if similarity is not None and similarity < 90 else ('minor' if similarity is not None and similarity < tolerance else None),
+                'processed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            }
+
+            comp_rows = db_insert('comparisons', [comp_insert])
+            comp_row = comp_rows[0] if comp_rows else None
+
+            if status == 'changed' and comp_row:
+                # Gemini only sees each changed region, cropped from both images
+                crops = []
+                if gemini_model and doc_bytes and screenshot_bytes and regions:
+                    try:
+                        if live_bgr is None:
+                            live_bgr = _bytes_to_bgr_array(screenshot_bytes)
+                        crops = _region_crop_pngs(_bytes_to_bgr_array(doc_bytes), live_bgr, regions, doc_offset)
+                    except ValueError as e:
+                        print(f"[ERROR] Could not crop regions for AI analysis: {e}", file=sys.stderr)
+
+                # Regions are analysed independently, so their Gemini calls run concurrently
+                if crops:
+                    with ThreadPoolExecutor(max_workers=GEMINI_WORKERS) as gemini_pool:
+                        analyses = list(gemini_pool.map(analyze_region, regions, crops))
+                else:
+                    analyses = ["No AI analysis performed."] * len(regions)
+
+                # change_details for all regions go in one multi-row insert
+                cds = []
+                for reg, gemini_analysis_text in zip(regions, analyses):
+                    desc = f'Detected change in region area {reg.get("area")}'
+                    cds.append({
+                        'comparison_id': comp_row.get('id'),
+                        'change_type': 'visual',
+                        'description': desc,
+                        'position_x': reg.get('x'),
+                        'position_y': reg.get('y'),
+                        'width': reg.get('width'),
+                        'height': reg.get('height'),
+                        'severity': 'major' if reg.get('area', 0) > 1000 else 'minor',
+                        'ai_analysis': {
+                            'confidence': 0.8, 
+                            'recommendation': 'Review and approve if intended.',
+                            'gemini_description': gemini_analysis_text
+                        }
+                    })
+                if cds:
+                    db_insert('change_details', cds)
 
         # Update run
-        supabase.table('runs').update({
+        db_update('runs', {
             'status': 'completed',
             'completed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
             'total_images': total_images,
             'changes_detected': changes_detected,
-        }).eq('id', run_id).execute()
+        }, run_id)
 
         print(f'Processed run {run_id}: images={total_images}, changes={changes_detected}')
 
@@ -449,25 +980,137 @@ def process_run_id(run_id: str):
         traceback.print_exc()
 
 
+def process_run_id(run_id: str):
+    """Process one run start to finish on the calling thread"""
+    job = capture_run(run_id)
+    if job is not None:
+        finish_run(job)
+
+
+def _run_id_from_change(payload: dict):
+    """Row id from a Realtime postgres_changes payload"""
+    data = payload.get('data') or payload
+    record = data.get('record') or data.get('new') or {}
+    return record.get('id')
+
+
+async def _watch_realtime(realtime, failed: asyncio.Event):
+    """
+    Return once the Realtime subscription is gone for good: the channel reported
+    an error, the client gave up reconnecting, or the server closed the socket
+    cleanly (the client's listen task then just ends, without reconnecting).
+    """
+    down_since = None
+    while True:
+        try:
+            await asyncio.wait_for(failed.wait(), timeout=REALTIME_CHECK_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+        # The client doesn't expose its listen task; a finished one means nothing is read anymore
+        listen_task = getattr(realtime, '_listen_task', None)
+        if realtime.is_connected and listen_task is not None and not listen_task.done():
+            down_since = None
+            continue
+        down_since = down_since or time.monotonic()
+        if time.monotonic() - down_since >= REALTIME_DOWN_GRACE:
+            print(f"[ERROR] Realtime connection lost for over {REALTIME_DOWN_GRACE}s", file=sys.stderr)
+            return
+
+
+async def listen_for_runs():
+    """
+    Process pending runs as Supabase Realtime pushes them, instead of polling
+    the `runs` table. Runs go through a two-stage pipeline: capture_run uses
+    Playwright's sync API, which can't run on the event loop, so one browser
+    thread takes screenshots and queues the jobs; RUN_CONSUMERS threads run
+    finish_run on them, so the next page loads while earlier runs are compared.
+
+    Returns once the subscription is lost, after finishing the captured runs;
+    the caller exits non-zero so the supervisor restarts the worker, and the
+    startup query picks up whatever was missed meanwhile.
+    """
+    run_pool = ThreadPoolExecutor(max_workers=1)  # the browser thread
+    work_q = queue.Queue(maxsize=RUN_QUEUE_SIZE)  # blocks the browser thread when consumers fall behind
+    queued = set()  # run ids submitted but not finished, so repeat events don't double-process
+
+    def capture(rid):
+        job = capture_run(rid)
+        if job is None:
+            queued.discard(rid)
+        else:
+            work_q.put(job)
+
+    def consume():
+        while True:
+            job = work_q.get()
+            if job is None:
+                return
+            finish_run(job)
+            queued.discard(job['run_id'])
+
+    consumers = [threading.Thread(target=consume, name=f'run-consumer-{n}', daemon=True)
+                 for n in range(RUN_CONSUMERS)]
+    for t in consumers:
+        t.start()
+
+    def enqueue(rid):
+        if not rid or rid in queued:
+            return
+        queued.add(rid)
+        print('Found run', rid)
+        run_pool.submit(capture, rid)
+
+    realtime_client = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    channel = realtime_client.channel('runs-pending')
+    for event in ('INSERT', 'UPDATE'):
+        channel.on_postgres_changes(event, schema='public', table='runs', filter='status=eq.pending',
+                                    callback=lambda payload: enqueue(_run_id_from_change(payload)))
+
+    failed = asyncio.Event()  # set when the subscription is lost; callbacks run on this loop
+
+    def on_subscribe(state, err):
+        # state is a RealtimeSubscribeStates (str enum)
+        if state == 'SUBSCRIBED':
+            print('Subscribed to pending runs')
+        elif state in ('CHANNEL_ERROR', 'TIMED_OUT', 'CLOSED'):
+            print(f"[ERROR] Realtime subscription to runs failed ({state}): {err}", file=sys.stderr)
+            failed.set()
+
+    await channel.subscribe(on_subscribe)
+
+    # Pick up runs created while the worker was down; subscribing first means none fall in between
+    try:
+        res = supabase.table('runs').select('id').eq('status', 'pending').order('created_at', desc=False).execute()
+        for row in res.data or []:
+            enqueue(row.get('id'))
+    except Exception:
+        traceback.print_exc()
+
+    try:
+        # Realtime callbacks run on this event loop; keep it alive while the socket is
+        await _watch_realtime(realtime_client.realtime, failed)
+    finally:
+        # The browser lives on the run thread, so it has to be closed there too
+        run_pool.submit(close_browser)
+        run_pool.shutdown(wait=True)
+        # Let the consumers finish what was captured, then stop them
+        for _ in consumers:
+            work_q.put(None)
+        for t in consumers:
+            t.join()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--run-id', dest='run_id', help='Process a specific run id')
     args = parser.parse_args()
 
     if args.run_id:
-        process_run_id(args.run_id)
+        try:
+            process_run_id(args.run_id)
+        finally:
+            close_browser()
     else:
-        # poll continuously
-        while True:
-            print('Polling for pending run...')
-            try:
-                res = supabase.table('runs').select('id').eq('status', 'pending').order('created_at', desc=False).limit(1).execute()
-                if res.data:
-                    rid = res.data[0].get('id')
-                    print('Found run', rid)
-                    process_run_id(rid)
-                else:
-                    print('No pending runs found, waiting...')
-            except Exception:
-                traceback.print_exc()
-            time.sleep(POLL_INTERVAL)
+        asyncio.run(listen_for_runs())
+        sys.exit(1)  # only returns when Realtime is lost
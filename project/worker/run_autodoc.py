@@ -18,6 +18,7 @@ def main():
     if not api_key:
         print("WARNING: GEMINI_API_KEY not found in environment variables.")
     
+    engine = None
     try:
         engine = AutoDocEngine(
             project_name=args.project_name,
@@ -35,6 +36,9 @@ def main():
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if engine:
+            engine.close()
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,6 @@
 <#
 Prompts for the Supabase service role key (secure input), then runs the Python worker
-for a given run id. The key is kept only in memory for the session and cleared afterwards.
+for a given run id, or keeps it listening for pending runs when no id is given. The key is kept only in memory for the session and cleared afterwards.
 Usage: .\run_worker_secure.ps1 -RunId <run-uuid>
 #>
 
@@ -20,7 +20,7 @@ try {
 
 # Prompt for run id if not provided
 if (-not $RunId) {
-  $RunId = Read-Host 'Enter run id to process (or leave blank to poll first pending run)'
+  $RunId = Read-Host 'Enter run id to process (or leave blank to keep listening for pending runs)'
 }
 
 # Set env vars for this session only
@@ -0,0 +1,64 @@
+"""
+SSIMReference alignment on text pages, where the quarter-scale phase
+correlation alone lands a few pixels off and leaves every text row flagged.
+
+process_run needs its runtime dependencies and Supabase settings at import;
+dummy settings are enough since nothing here talks to Supabase.
+"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+for module in ('supabase', 'playwright', 'google.generativeai'):
+    pytest.importorskip(module)
+
+os.environ.setdefault('SUPABASE_URL', 'http://localhost:54321')
+os.environ.setdefault('SUPABASE_SERVICE_ROLE_KEY', 'test.service.role')
+
+from process_run import SSIMReference  # noqa: E402
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+
+
+def _text_page(w=1280, h=2400, seed=0):
+    """White page with rows of anti-aliased text, like a docs screenshot"""
+    rng = np.random.default_rng(seed)
+    img = np.full((h, w), 255, np.uint8)
+    for y in range(40, h - 20, 24):
+        cv2.putText(img, ' '.join(rng.choice(WORDS, 8)), (30, y),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1, cv2.LINE_AA)
+    return img
+
+
+def _shifted(img, dx, dy):
+    h, w = img.shape
+    return cv2.warpAffine(img, np.float32([[1, 0, dx], [0, 1, dy]]), (w, h),
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+@pytest.mark.parametrize('dx, dy', [(0, 3), (0, 12), (0, 30), (0, 40), (5, 17)])
+def test_text_page_shift_is_recovered(dx, dy):
+    page = _text_page()
+    ref = SSIMReference(cv2.imencode('.png', page)[1].tobytes())
+    other = cv2.imencode('.png', _shifted(page, dx, dy))[1].tobytes()
+
+    similarity, regions, diff, offset = ref.compare_many([other])[0]
+
+    assert offset == pytest.approx((dx, dy), abs=0.25)
+    assert similarity > 99.0
+    assert regions == []
+    assert diff is None
+
+
+def test_unshifted_page_has_no_offset():
+    page = _text_page()
+    ref = SSIMReference(cv2.imencode('.png', page)[1].tobytes())
+
+    similarity, regions, _, offset = ref.compare_many([cv2.imencode('.png', page)[1].tobytes()])[0]
+
+    assert offset is None
+    assert similarity == 100.0
+    assert regions == []